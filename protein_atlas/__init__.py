@@ -1,9 +1,13 @@
 import os
+import queue
 import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from zipfile import ZipFile
 
 from clint.textui import progress
+from joblib import Parallel, delayed
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
@@ -15,69 +19,211 @@ from sklearn.preprocessing import MultiLabelBinarizer
 from iterstrat.ml_stratifiers import MultilabelStratifiedKFold
 
 from keras.utils import Sequence
-from keras.preprocessing.image import ImageDataGenerator
+
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+try:
+    import pyvips
+except (ImportError, OSError):
+    # OSError: the pyvips package is installed but libvips is not.
+    pyvips = None
 
 from .install import PATH
 
+# Target classes, see `ProteinAtlas.classes`.
+_CLASSES = ("Nucleoplasm", "Nuclear membrane", "Nucleoli",
+            "Nucleoli fibrillar center", "Nuclear speckles",
+            "Nuclear bodies", "Endoplasmic reticulum", "Golgi apparatus",
+            "Peroxisomes", "Endosomes", "Lysosomes",
+            "Intermediate filaments", "Actin filaments",
+            "Focal adhesion sites", "Microtubules", "Microtubule ends",
+            "Cytokinetic bridge", "Mitotic spindle",
+            "Microtubule organizing center", "Centrosome", "Lipid droplets",
+            "Plasma membrane", "Cell junctions", "Mitochondria",
+            "Aggresome", "Cytosol", "Cytoplasmic bodies", "Rods & rings")
+_N_CLASSES = len(_CLASSES)
+_CLASS_INDEX = {class_ : ix for ix, class_ in enumerate(_CLASSES)}
+
+# Image channels and the color identifying each in the .png file names, see
+# `ProteinAtlas.channels` and `ProteinAtlas.channel_colors`.
+_CHANNELS = ("Microtubules", "Antibody", "Nucleus", "Endoplasmic Reticulum")
+_CHANNEL_COLORS = ("red", "green", "blue", "yellow")
+_N_CHANNELS = len(_CHANNELS)
+
+def _tmp_path(path):
+    """Temporary path next to `path`, unique to the calling process and thread,
+    to write a file to before moving it onto `path` with `os.replace`. Unlike
+    `tempfile.mkstemp`, files opened there get the default permissions.
+    """
+    path = Path(path)
+    return path.with_name("{}.{}.{}.tmp".format(path.name, os.getpid(),
+                                                threading.get_ident()))
+
+def _decode(path):
+    """Decode a single-band .png file at `path` into a uint8 ndarray, using
+    pyvips if it is installed and PIL otherwise.
+    """
+    if pyvips is not None:
+        img = pyvips.Image.new_from_file(str(path), access = "sequential",
+                                         memory = True)
+        return img.numpy().astype(np.uint8, copy=False)
+    return np.asarray(Image.open(path), dtype=np.uint8)
+
+if njit is not None:
+    @njit(parallel=True, fastmath=True)
+    def _render(levels, luts, out):
+        """Average the colormap lookup tables `luts` of shape (n_channels, 256, 4)
+        over the channels of the uint8 batch `levels`, writing into `out` of
+        shape (n_samples, rows, cols, 4).
+        """
+        nsamples, nrows, ncols, nchannels = levels.shape
+        for n in prange(nsamples):
+            for h in range(nrows):
+                for w in range(ncols):
+                    r = g = b = a = 0.
+                    for c in range(nchannels):
+                        r += luts[c,levels[n,h,w,c],0]
+                        g += luts[c,levels[n,h,w,c],1]
+                        b += luts[c,levels[n,h,w,c],2]
+                        a += luts[c,levels[n,h,w,c],3]
+                    out[n,h,w,0] = r / nchannels
+                    out[n,h,w,1] = g / nchannels
+                    out[n,h,w,2] = b / nchannels
+                    out[n,h,w,3] = a / nchannels
+else:
+    _render = None
+
+def _fill_memmap(path, start, paths):
+    """Decode the images whose per-channel .png file paths are `paths` into
+    the rows of the .npy memory map at `path` starting at row `start`. Run in
+    worker processes by `build_memmap`.
+    """
+    mm = np.load(path, mmap_mode = "r+")
+    for row, row_paths in enumerate(paths, start):
+        for chan_ix, chan_path in enumerate(row_paths):
+            mm[row,:,:,chan_ix] = _decode(chan_path)
+    mm.flush()
+
+def _stratified_batches(y, batch_size):
+    """Split the samples of the multi-hot label matrix `y` into batches of at
+    most `batch_size` samples, with each class spread as evenly as possible
+    among the batches.
+
+    Samples are assigned greedily, those of the rarest classes first, each to
+    the batch holding the fewest samples of the sample's rarest class.
+
+    Parameters:
+
+        y : ndarray, shape (n_samples, n_classes)
+
+        batch_size : int
+
+    Returns:
+
+        batch_sets : list of ndarray of int
+
+            Row indices of `y` in each batch.
+    """
+    n_samples, n_classes = y.shape
+    n_batches = int(np.ceil(n_samples/float(batch_size)))
+    capacity = np.full(n_batches, n_samples // n_batches)
+    capacity[:n_samples % n_batches] += 1
+
+    # Rarest class of each sample; unlabeled samples get a class count of
+    # n_samples + 1 so that they are assigned last.
+    class_counts = y.sum(axis = 0)
+    sample_counts = np.where(y > 0, class_counts, n_samples + 1)
+    rarest = sample_counts.argmin(axis = 1)
+    order = np.argsort(sample_counts.min(axis = 1), kind = "stable")
+
+    counts = np.zeros((n_batches, n_classes), dtype = np.int64)
+    sizes = np.zeros(n_batches, dtype = np.int64)
+    assignment = np.empty(n_samples, dtype = np.int64)
+    for sample_ix in order:
+        # Ties between batches go to the one with fewest samples.
+        score = counts[:,rarest[sample_ix]] + sizes / (batch_size + 1.)
+        score[sizes >= capacity] = np.inf
+        batch_ix = score.argmin()
+        assignment[sample_ix] = batch_ix
+        counts[batch_ix] += y[sample_ix]
+        sizes[batch_ix] += 1
+
+    order = np.argsort(assignment, kind = "stable")
+    return np.split(order, np.cumsum(sizes)[:-1])
+
 class ProteinAtlas():
-    def __init__(self,img_path):
+    # Lookup table scaling uint8 pixel values to float32 values in [0, 1].
+    _U8_TO_F01 = (np.arange(256)/255.).astype(np.float32)
+
+    def __init__(self,img_path,max_workers = 8,cache = False,cache_dir = None):
+        """Parameters:
+
+            img_path : pathlib.Path
+
+                Directory containing the .png images of the dataset.
+
+            max_workers : int, default 8
+
+                Number of threads used to decode .png files in `get_images`.
+
+            cache : bool, default False
+
+                If true, store each decoded 4-band image as a uint8 .npy file
+                in `cache_dir` and read it back instead of decoding the .png
+                files on later requests.
+
+            cache_dir : pathlib.Path, optional
+
+                Directory of the .npy image cache. Defaults to a subdirectory
+                of PATH["cache"] named after `img_path`.
+        """
         self.img_path = img_path
+        self.max_workers = max_workers
+        self.cache = cache
+        if cache_dir is None:
+            cache_dir = PATH["cache"].joinpath(img_path.name)
+        self.cache_dir = Path(cache_dir)
+        self._executor = None
+        self._mm = None
+        self._mm_path = None
+        self._id_to_row = None
         self.cmaps = []
         for chan_ix in range(self.n_channels):
             self.cmaps.append(self.make_cmap(chan_ix,as_cmap=True))
 
+        # Colormaps sampled at each of the 256 intensity levels, with shape
+        # (n_channels, 256, 4); `render_batch` reads the float32 copy.
+        levels = np.linspace(0,1,256)
+        self.luts = np.stack([cmap(levels) for cmap in self.cmaps])
+        self._luts_f32 = self.luts.astype(np.float32)
+
     def any(self, class_):
         """
         Return examples belonging to any of the classes in `class_`.
 
         Parameters:
 
-            class_: int or iterable of ints
-
-                Integer index or indices of classes to get examples from.
-        """
-        if isinstance(class_, pd.Index):
-            mask = pd.DataFrame(self.labels.loc[:,class_] == 1).any(axis = 1)
-        elif isinstance(class_, int) or (isinstance(class_, list) and isinstance(class_[0],int)):
-            mask = pd.DataFrame(self.labels.iloc[:,class_] == 1).any(axis = 1)
-        elif isinstance(class_, str):
-            class_ = pd.Index([class_])
-            mask = pd.DataFrame(self.labels.loc[:,class_] == 1).any(axis = 1)
-
-        return self.labels.loc[mask]
-
+            class_: int, str or iterable of ints or strs
 
-    def render_batch(self,X):
-        """Render a batch of images X in the HUSL colorspace for maximizing
-        perceptual uniformity of each channel.
-
-        Parameters:
-
-            X : ndarray, (n_samples, rows, cols, 4)
+                Integer index or indices, or names, of classes to get examples
+                from.
 
         Returns:
-        
-            X_new : ndarray, (n_samples, rows_new, cols_new, 4)
 
-               Batch of images in RGBa channels.
+            labels : pd.DataFrame
+
+                The rows of `self.labels` of the matching examples.
         """
-        if len(X.shape) == 3:
-            samples = 1
-            row, cols, channels = X.shape
-            X = X.reshape((1,rows,cols,channels))
-        elif len(X.shape) == 4:
-            samples, rows, cols, channels = X.shape
-        else:
-            pass
+        if np.isscalar(class_):
+            class_ = [class_]
+        cols = [_CLASS_INDEX[c] if isinstance(c, str) else c for c in class_]
+        rows = np.flatnonzero(self.labels_array[:,cols].any(axis = 1))
+
+        return self.labels.take(rows)
 
-        bands = [0] * self.n_channels
-        img = np.zeros((self.height,self.width,4))
-        for chan in range(self.n_channels):
-            bands[chan] = self.cmaps[chan](X[sample,:,:,chan])
-            img = img + bands[chan]/self.n_channels
-            
-        img = Image.fromarray(np.uint8(img*255))
-        return img
 
     @property
     def nrows(self): return 512
@@ -93,44 +239,24 @@ class ProteinAtlas():
         Each of these classes represents a possible location in a human cell
         where a protein of interest resides.
         """
-        return ["Nucleoplasm", "Nuclear membrane", "Nucleoli",
-                "Nucleoli fibrillar center", "Nuclear speckles",
-                "Nuclear bodies", "Endoplasmic reticulum", "Golgi apparatus",
-                "Peroxisomes", "Endosomes", "Lysosomes",
-                "Intermediate filaments", "Actin filaments",
-                "Focal adhesion sites", "Microtubules", "Microtubule ends",
-                "Cytokinetic bridge", "Mitotic spindle",
-                "Microtubule organizing center", "Centrosome", "Lipid droplets",
-                "Plasma membrane", "Cell junctions", "Mitochondria",
-                "Aggresome", "Cytosol", "Cytoplasmic bodies", "Rods & rings"]
+        return _CLASSES
 
     @property
     def n_classes(self):
-        return len(self.classes)
+        return _N_CLASSES
                        
     def make_cmap(self,chan_ix,**kwds):
         return sns.cubehelix_palette(start = chan_ix*3.0/self.n_channels,
                                      dark = 0, light = 1, gamma = 2.0, rot = 0,
                                      hue = 1, **kwds)
 
-    @property
-    def channel_colors(self):
-        """
-        Color of each channel in the Protein Atlas dataset.  These are not
-        technically colors, just identifiers necessary to locate the path of
-        each .png file.
-        """
-        return ["red", "green", "blue", "yellow"]
-
-
     @property
     def channels(self):
         """
         Channels present in the Protein Atlas dataset.
         """
-        return ["Microtubules", "Antibody", "Nucleus", "Endoplasmic Reticulum"]
+        return _CHANNELS
 
-    
     @property
     def channel_colors(self):
         """
@@ -138,12 +264,12 @@ class ProteinAtlas():
         technically colors, just identifiers necessary to locate the path of
         each .png file.
         """
-        return ["red", "green", "blue", "yellow"]
+        return _CHANNEL_COLORS
 
     @property
     def n_channels(self):
         """Number of channels in each image of the Protein Atlas dataset."""
-        return len(self.channels)
+        return _N_CHANNELS
 
     def get_path(self,id_,channel_ix):
         """
@@ -164,10 +290,10 @@ class ProteinAtlas():
                     3. yellow (endoplasmic reticulum band)
         """
         channel_color = self.channel_colors[channel_ix]
-        return self.img_path.joinpath("{}_{}.png".format(id_,channel_color))
+        return self.img_path.joinpath(f"{id_}_{channel_color}.png")
 
 
-    def get_image(self,id_):
+    def get_image(self,id_,out = None,buf = None):
         """Get the 4-band image corresponding to example `id_`, returning a numpy array
         of shape (512, 512, 4)
 
@@ -177,88 +303,409 @@ class ProteinAtlas():
 
                 The ID of the sample.
 
+            out : ndarray of float32, shape (512, 512, 4), optional
+
+                If given, the image is written into `out`.
+
+            buf : ndarray of uint8, shape (512, 512, 4), optional
+
+                Scratch buffer the raw image is decoded into. Passing both
+                `out` and `buf` avoids allocating any array.
+
         Returns:
 
-            img : ndarray of float, shape (512, 512, 4)
+            img : ndarray of float32, shape (512, 512, 4)
 
                 Values range between 0 and 1.
         """
-        bands = [None] * self.n_channels
+        # mode = "clip" lets np.take write into `out` without buffering; the
+        # uint8 indices are always in range of the 256 entry table.
+        return np.take(self._U8_TO_F01, self.read_image(id_, out = buf),
+                       out = out, mode = "clip")
+
+    def get_cache_path(self,id_):
+        """Get the file path of the cached .npy array for example `id_`."""
+        return self.cache_dir.joinpath("{}.npy".format(id_))
+
+    def read_image(self,id_,out = None):
+        """Get the 4-band image corresponding to example `id_` as raw uint8
+        values, shape (512, 512, 4).
+
+        If `self.cache` is true, the image is read from its .npy file in
+        `self.cache_dir`, which is written on the first request.
+
+        Parameters:
+
+            id_ : str
+
+                The ID of the sample.
+
+            out : ndarray of uint8, shape (512, 512, 4), optional
+
+                If given, each band is decoded directly into `out`, which is
+                returned.
+        """
+        if out is None:
+            out = np.empty((self.nrows,self.ncols,self.n_channels),
+                           dtype = np.uint8)
+
+        if self.cache:
+            cache_path = self.get_cache_path(id_)
+            if cache_path.exists():
+                out[...] = np.load(cache_path, mmap_mode = "r")
+                return out
+
         for chan_ix in range(self.n_channels):
-            chan_path = self.get_path(id_,chan_ix)
-            bands[chan_ix] = Image.open(chan_path)
-        
-        return np.stack(bands, axis=2) / 255
+            out[:,:,chan_ix] = _decode(self.get_path(id_,chan_ix))
+
+        if self.cache:
+            # Write to a temporary file first, so that an interrupted write
+            # never leaves a truncated file at `cache_path`.
+            self.cache_dir.mkdir(parents=True,exist_ok=True)
+            tmp_path = _tmp_path(cache_path)
+            try:
+                with open(tmp_path, "wb") as f:
+                    np.save(f, out)
+                os.replace(tmp_path, cache_path)
+            except BaseException:
+                if tmp_path.exists():
+                    tmp_path.unlink()
+                raise
+
+        return out
+
+    def __getstate__(self):
+        # Thread pools can not be pickled; each process spawned by Keras for
+        # `use_multiprocessing = True` starts its own pool on first use.
+        # Memory maps are reopened from `_mm_path` rather than pickled, which
+        # would copy the whole dataset.
+        state = self.__dict__.copy()
+        state["_executor"] = None
+        state["_mm"] = None
+        return state
 
-    def get_images(self,ids):
+    @property
+    def executor(self):
+        """Thread pool used to decode images, created on first use and reused
+        across batches.
+        """
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers = self.max_workers)
+        return self._executor
+
+    @property
+    def memmap_path(self):
+        """Default path of the dataset memory map written by `build_memmap`."""
+        return self.cache_dir.with_suffix(".npy")
+
+    def build_memmap(self,path = None,n_jobs = -1):
+        """Decode every image in `self.index` into a single .npy file holding a
+        uint8 array of shape (n_samples, 512, 512, 4), then load it with
+        `load_memmap`.
+
+        Parameters:
+
+            path : pathlib.Path, optional
+
+                Path of the .npy file, defaults to `self.memmap_path`.
+
+            n_jobs : int, default -1
+
+                Number of worker processes decoding images, each writing its
+                own chunk of rows. -1 uses all CPUs.
+        """
+        path = Path(self.memmap_path if path is None else path)
+        path.parent.mkdir(parents=True,exist_ok=True)
+
+        # Build into a temporary file and move it to `path` only once every
+        # row is written, so that a failed build never leaves a partially
+        # zero-filled array where `load_memmap` would read it.
+        tmp_path = _tmp_path(path)
+        try:
+            shape = (len(self.index),self.nrows,self.ncols,self.n_channels)
+            mm = np.lib.format.open_memmap(tmp_path, mode = "w+",
+                                           dtype = np.uint8, shape = shape)
+            del mm
+
+            # Workers get only the .png paths of their chunk of rows, and
+            # decode them directly, bypassing the per-image .npy cache.
+            paths = [[str(self.get_path(id_,chan_ix))
+                      for chan_ix in range(self.n_channels)]
+                     for id_ in self.index]
+            starts = range(0, len(paths), 256)
+            Parallel(n_jobs = n_jobs, backend = "loky")(
+                delayed(_fill_memmap)(str(tmp_path), start, paths[start:start+256])
+                for start in starts)
+
+            os.replace(tmp_path, path)
+        except BaseException:
+            if tmp_path.exists():
+                tmp_path.unlink()
+            raise
+
+        self.load_memmap(path)
+
+    def load_memmap(self,path = None):
+        """Read images in `get_images` from the .npy file at `path` written by
+        `build_memmap`, instead of from the .png files.
+
+        Parameters:
+
+            path : pathlib.Path, optional
+
+                Path of the .npy file, defaults to `self.memmap_path`.
+        """
+        self._mm_path = Path(self.memmap_path if path is None else path)
+        self._mm = None
+        self._id_to_row = {id_ : row for row, id_ in enumerate(self.index)}
+
+    @property
+    def memmap(self):
+        """The dataset memory map loaded by `load_memmap`, or None."""
+        if self._mm is None and self._mm_path is not None:
+            self._mm = np.load(self._mm_path, mmap_mode = "r")
+        return self._mm
+
+    def get_images(self,ids,scale = True):
         """
         Given a pd.Index of example IDs, return an array of shape
         (samples,rows,cols,channels)
+
+        If `scale` is true, the array holds float32 values between 0 and 1;
+        otherwise it holds the raw uint8 values.
+
+        If a memory map was loaded with `load_memmap`, the images are read from
+        it.
+
+        Every (sample, channel) .png file of the batch is submitted to
+        `self.executor` at once, so that decoding runs in parallel; PIL
+        releases the GIL while decompressing. If `self.cache` is true, whole
+        samples are submitted instead, each read through `read_image`.
         """
-        X = np.zeros((len(ids),self.nrows,self.ncols,self.n_channels))
+        if self.memmap is not None:
+            rows = [self._id_to_row[id_] for id_ in ids]
+            X = self.memmap[rows]
+            return self._U8_TO_F01[X] if scale else X
+
+        X = np.empty((len(ids),self.nrows,self.ncols,self.n_channels),
+                     dtype = np.uint8)
+        if self.cache:
+            # Each sample is read directly into its row of X.
+            list(self.executor.map(self.read_image,ids,X))
+            return self._U8_TO_F01[X] if scale else X
+
+        keys  = []
+        paths = []
         for sample_ix, id_ in enumerate(ids):
-            X[sample_ix,:,:,:] = self.get_image(id_)
+            for chan_ix in range(self.n_channels):
+                keys.append((sample_ix,chan_ix))
+                paths.append(self.get_path(id_,chan_ix))
 
-        return X
+        for (sample_ix, chan_ix), band in zip(keys, self.executor.map(_decode,paths)):
+            X[sample_ix,:,:,chan_ix] = band
+
+        return self._U8_TO_F01[X] if scale else X
 
     def render_batch(self,imgs):
+        """Render a batch of images with each channel mapped through its
+        colormap in `self.cmaps`, averaging the channels. Uses a compiled
+        loop if numba is installed.
+
+        Parameters:
+
+            imgs : ndarray, (n_samples, rows, cols, n_channels)
+
+                Float values between 0 and 1, or uint8 values.
+
+        Returns:
+
+            new_imgs : ndarray of float32, (n_samples, rows, cols, 4)
+
+                Batch of images in RGBa channels.
+        """
         nsamples, nrows, ncols, nchannels = imgs.shape
 
-        new_imgs = np.zeros((nsamples, nrows, ncols, 4))
-        bands = np.split(imgs,nchannels,axis = 3)
-        for channel in range(nchannels):
-            bands[channel] = np.squeeze(bands[channel],axis = 3)
-            bands[channel] = self.cmaps[channel](bands[channel])
-            new_imgs = new_imgs + bands[channel] / nchannels
+        if imgs.dtype == np.uint8:
+            levels = imgs
+        else:
+            # Same binning a 256 color matplotlib colormap applies to floats.
+            levels = np.clip(imgs*256, 0, 255).astype(np.uint8)
+
+        if _render is not None:
+            new_imgs = np.empty((nsamples, nrows, ncols, 4), dtype = np.float32)
+            _render(levels, self._luts_f32, new_imgs)
+            return new_imgs
 
-        return new_imgs
+        # Without numba, gather every channel from its lookup table at once,
+        # giving shape (n_samples, rows, cols, n_channels, 4), then average
+        # the channels.
+        new_imgs = self._luts_f32[np.arange(nchannels), levels]
+        return new_imgs.sum(axis = -2) / np.float32(nchannels)
 
 
 class Test(ProteinAtlas):
-    def __init__(self):
-        super().__init__(img_path = PATH["test"])
+    def __init__(self, **kwds):
+        super().__init__(img_path = PATH["test"], **kwds)
         df = pd.read_csv(PATH["sample_submission.csv"]).set_index("Id")
         self.index = df.index
 
-    def get_generator(self, batch_size = 128):
-        return TestGenerator(self,batch_size)
+    def get_generator(self, batch_size = 128, **kwds):
+        return TestGenerator(self,batch_size,**kwds)
         
 
 
 class Train(ProteinAtlas):
-    def __init__(self):
-        super().__init__(img_path = PATH["train"])
+    def __init__(self, **kwds):
+        super().__init__(img_path = PATH["train"], **kwds)
         df          = pd.read_csv(PATH["train.csv"]).set_index("Id")
         read_target = lambda s: np.array(s.split(" "),dtype=np.int32)
         targets     = df["Target"].apply(read_target)
         mlb         = MultiLabelBinarizer()
         labels      = mlb.fit_transform(targets.values)
         index       = targets.index
-        columns     = self.classes
+        columns     = list(self.classes)
         self.mlb = mlb
-        self.labels = pd.DataFrame(labels,index,columns)
-        self.index  = self.labels.index
-
-    def train_test_split(self,train_portion, batch_size = 32):
+        # Multi-hot label matrix, shape (n_samples, n_classes), for indexing
+        # batches without pandas overhead. `labels` is a labeled view of it.
+        self.labels_array = np.ascontiguousarray(labels, dtype = np.uint8)
+        self.ids    = index
+        self.labels = pd.DataFrame(self.labels_array,index,columns,copy=False)
+        self.index  = self.ids
+
+    def train_test_split(self,train_portion, batch_size = 32, **kwds):
         mskf = MultilabelStratifiedKFold(n_splits = int(1/(1-train_portion)))
-        train_set, val_set = mskf.split(X = self.labels, y = self.labels).__next__()
+        y = self.labels_array
+        train_set, val_set = mskf.split(X = y, y = y).__next__()
 
-        train_generator = TrainGenerator(self,train_set,batch_size)
-        val_generator = TrainGenerator(self,train_set,batch_size)
+        train_generator = TrainGenerator(self,train_set,batch_size,**kwds)
+        kwds.pop("augment", None)
+        val_generator = TrainGenerator(self,val_set,batch_size,**kwds)
 
         return train_generator, val_generator
 
+    def as_tf_dataset(self, rows = None, batch_size = 32, shuffle = True,
+                      scale = False):
+        """Build a tf.data pipeline yielding batches of (images, labels), which
+        reads and decodes the .png files in parallel inside the TensorFlow
+        runtime and prefetches batches while the model trains.
+
+        Parameters:
+
+            rows : ndarray of int, optional
+
+                Row indices of the examples to use, e.g. a fold from
+                `MultilabelStratifiedKFold`. Defaults to all examples.
+
+            batch_size : int, default 32
+
+            shuffle : bool, default True
+
+                If true, reshuffle the examples every epoch.
+
+            scale : bool, default False
+
+                If true, images are float32 values between 0 and 1 rather
+                than uint8 values.
+
+        Returns:
+
+            dataset : tf.data.Dataset
+        """
+        # Imported here so that TensorFlow is only needed by this pipeline.
+        import tensorflow as tf
+
+        if rows is None:
+            rows = np.arange(len(self.ids))
+        paths = np.array([[str(self.get_path(id_,chan_ix))
+                           for chan_ix in range(self.n_channels)]
+                          for id_ in self.ids[rows]])
+        labels = self.labels_array[rows]
+        shape = (self.nrows,self.ncols,self.n_channels)
+
+        def load(paths, labels):
+            bands = [tf.io.decode_png(tf.io.read_file(paths[chan_ix]), channels = 1)
+                     for chan_ix in range(self.n_channels)]
+            img = tf.concat(bands, axis = -1)
+            img.set_shape(shape)
+            if scale:
+                img = tf.cast(img, tf.float32) / 255.
+            return img, labels
+
+        autotune = tf.data.experimental.AUTOTUNE
+        dataset = tf.data.Dataset.from_tensor_slices((paths, labels))
+        if shuffle:
+            dataset = dataset.shuffle(len(rows), reshuffle_each_iteration = True)
+        return (dataset
+                .map(load, num_parallel_calls = autotune)
+                .batch(batch_size)
+                .prefetch(autotune))
+
+
+
+class GeneratorMixin():
+    """Settings for loading batches of a Sequence in parallel worker
+    processes, so that image loading overlaps with training:
+
+        model.fit_generator(gen, **gen.fit_kwds)
+
+    which is equivalent to
+
+        model.fit_generator(gen, workers = 8, use_multiprocessing = True,
+                            max_queue_size = 16)
+
+    for the default settings.
 
+    Image batches are uint8 unless the generator is created with
+    `scale = True`; scale them to [0, 1] in the model instead. The model input
+    must itself be uint8, otherwise Keras casts each batch to float32 on the
+    host before copying it to the device:
 
-class TrainGenerator(Sequence):
+        inputs = Input(batch_shape = (None,512,512,4), dtype = "uint8")
+        X = Lambda(lambda x: K.cast(x, "float32") / 255.)(inputs)
+    """
+    def init_workers(self, workers = 8, prefetch_factor = 2, scale = False):
+        """Parameters:
+
+            workers : int, default 8
+
+                Number of worker processes loading batches.
+
+            prefetch_factor : int, default 2
+
+                Number of batches queued ahead per worker.
+
+            scale : bool, default False
+
+                If true, image batches are float32 values between 0 and 1
+                rather than uint8 values.
+        """
+        self.workers = workers
+        self.prefetch_factor = prefetch_factor
+        self.scale = scale
+
+    @property
+    def max_queue_size(self):
+        return self.prefetch_factor * self.workers
+
+    @property
+    def fit_kwds(self):
+        """Keyword arguments for `fit_generator` and `predict_generator`."""
+        return {"workers"             : self.workers,
+                "use_multiprocessing" : True,
+                "max_queue_size"      : self.max_queue_size}
+
+
+class TrainGenerator(GeneratorMixin, Sequence):
     """Data generator for generating batches of data from the Train dataset.
 
     This source of the data will be taken to be a cross validation fold.
 
-    The use of MultilabelStratifiedKFold inside this class is to ensure labels
-    distributions batches are evenly mixed among all classes.
+    The batches are built once with `_stratified_batches`, to ensure labels
+    distributions batches are evenly mixed among all classes; only their order
+    is shuffled between epochs.
     """
-    def __init__(self, train, train_set, batch_size = 32, augment = False):
+    def __init__(self, train, train_set, batch_size = 32, augment = False,
+                 workers = 8, prefetch_factor = 2, scale = False, seed = None):
         """Parameters:
         
             train : intance of Train
@@ -266,51 +713,134 @@ class TrainGenerator(Sequence):
             train_set : ndarray, int
 
                 The indices of the training set.
+
+            augment : bool, default False
+
+                If true, randomly flip each image of a batch horizontally and
+                vertically.
+
+            seed : int, optional
+
+                Seed of the random flips. Each batch's flips are drawn from a
+                generator seeded with (seed, epoch, batch index), so they are
+                reproducible and differ between Keras worker processes.
+                Defaults to a seed drawn from `np.random`.
+
+            workers, prefetch_factor : int
+            scale : bool
+
+                See `GeneratorMixin.init_workers`.
         """
-        self.batch_size = 32
+        self.init_workers(workers, prefetch_factor, scale)
+        self.batch_size = batch_size
+        self.augment = augment
+        if seed is None:
+            seed = np.random.randint(2**31)
+        self.seed = seed
+        self.epoch = 0
         self.train = train
         self.train_set = train_set
-        self.n_splits = int(np.ceil(len(train_set)/float(self.batch_size)))
-        self.mskf = MultilabelStratifiedKFold(n_splits = self.n_splits)
-
-        y = self.train.labels.values[self.train_set]
-        X = y # dummy argument for MultilabelStratifiedKFold.fit()
 
-        # Select batch sets from k-fold test sets
-        self.batch_sets = [test_set for _ , test_set in self.mskf.split(X,y)]
-        self.img_gen = ImageDataGenerator(
-            fill_mode = "constant", cval = 0.,
-            horizontal_flip = True,
-            vertical_flip = True)
+        y = self.train.labels_array[self.train_set]
 
+        # The batches index into `train_set`; map them back to rows of `train`
+        # and sort them so each batch reads its images in index order.
+        self.batch_sets = [np.sort(self.train_set[batch_set])
+                           for batch_set in _stratified_batches(y, batch_size)]
 
     def __len__(self):
         return len(self.batch_sets)
 
+    def on_epoch_end(self):
+        """Shuffle the order of the batches, keeping each batch's contents."""
+        np.random.shuffle(self.batch_sets)
+        self.epoch += 1
+
     def __getitem__(self, index):
         """Returns the ith batch of the data to be generated."""
         batch_set = self.batch_sets[index]
-        batch_index = self.train.labels.index[batch_set]
-        x_batch = self.train.get_images(batch_index)
-        y_batch = self.train.labels.values[batch_set,:]
-        
-        # x_aug = []
-        # y_aug = []
-        # for X, y in self.img_gen.flow(x_batch, y_batch):
-        #     x_aug.append(X)
-        #     y_aug.append(y)
-
-        # x_aug = np.concatenate(x_aug,axis = 0)
-        # y_aug = np.concatenate(y,axis = 0)
-
-        # return x_aug, y_aug
+        batch_index = self.train.ids[batch_set]
+        x_batch = self.train.get_images(batch_index, self.scale)
+        y_batch = self.train.labels_array[batch_set]
+
+        if self.augment:
+            # Not the global NumPy random state, which forked Keras workers
+            # share and would draw the same flips from.
+            rng = np.random.RandomState([self.seed, self.epoch, index])
+            n = len(x_batch)
+            h_mask = rng.rand(n) < 0.5
+            x_batch[h_mask] = x_batch[h_mask,:,::-1,:]
+            v_mask = rng.rand(n) < 0.5
+            x_batch[v_mask] = x_batch[v_mask,::-1,:,:]
 
         return x_batch, y_batch
 
-class TestGenerator(Sequence):
+class _PrefetchWrapper():
+    """Background thread loading the batches `load(index)` for `index` in
+    `range(start, stop)` in order, keeping up to `maxsize` of them queued.
+    """
+    def __init__(self, load, start, stop, maxsize = 2):
+        self.queue = queue.Queue(maxsize = maxsize)
+        self.stop_event = threading.Event()
+        self.next_index = start
+        self.thread = threading.Thread(target = self._run,
+                                       args = (load, start, stop),
+                                       daemon = True)
+        self.thread.start()
+
+    def _run(self, load, start, stop):
+        for index in range(start, stop):
+            try:
+                item = (index, load(index), None)
+            except Exception as e:
+                item = (index, None, e)
+            while not self.stop_event.is_set():
+                try:
+                    self.queue.put(item, timeout = 0.1)
+                    break
+                except queue.Full:
+                    pass
+            if self.stop_event.is_set() or item[2] is not None:
+                return
+
+    def get(self):
+        """Return the next batch, re-raising any error raised loading it.
+
+        Raises RuntimeError if the thread was closed or stopped without
+        loading another batch.
+        """
+        while True:
+            try:
+                index, batch, error = self.queue.get(timeout = 0.1)
+                break
+            except queue.Empty:
+                pass
+            if self.stop_event.is_set():
+                raise RuntimeError("prefetch thread was closed")
+            if not self.thread.is_alive():
+                # The thread may have queued its last batch before exiting.
+                try:
+                    index, batch, error = self.queue.get_nowait()
+                    break
+                except queue.Empty:
+                    raise RuntimeError("prefetch thread stopped without "
+                                       "loading batch {}".format(self.next_index))
+        if error is not None:
+            # The thread has exited; never reuse it.
+            self.next_index = None
+            raise error
+        self.next_index = index + 1
+        return batch
+
+    def close(self):
+        self.stop_event.set()
+
+
+class TestGenerator(GeneratorMixin, Sequence):
     """Data generator for generating batches of data from the Test dataset.
     """
-    def __init__(self, test, batch_size = 32):
+    def __init__(self, test, batch_size = 32, workers = 8, prefetch_factor = 2,
+                 scale = False, prefetch = False):
         """Parameters:
         
             train : intance of Train
@@ -318,20 +848,84 @@ class TestGenerator(Sequence):
             train_set : ndarray, int
 
                 The indices of the training set.
+
+            workers, prefetch_factor : int
+            scale : bool
+
+                See `GeneratorMixin.init_workers`.
+
+            prefetch : bool, default False
+
+                If true, load the batches following the requested one in a
+                background thread. `fit_kwds` then sets `workers = 0`.
         """
+        self.init_workers(workers, prefetch_factor, scale)
         self.test = test
         self.batch_size = batch_size
         self.batch_sets = np.array_split(np.arange(len(test.index)),len(self))
+        self.prefetch = prefetch
+        self._prefetcher = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # Threads and locks can not be pickled; worker processes start their
+        # own.
+        state = self.__dict__.copy()
+        state["_prefetcher"] = None
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
 
-    # def on_epoch_end(self,epoch):
-    #     self.mskf = MultilabelStratifiedKFold(n_splits = self.n_splits)
+    @property
+    def fit_kwds(self):
+        """Keyword arguments for `predict_generator`. With `prefetch`, batches
+        must be requested in order from a single thread, so Keras workers are
+        disabled.
+        """
+        if self.prefetch:
+            return {"workers"             : 0,
+                    "use_multiprocessing" : False,
+                    "max_queue_size"      : self.max_queue_size}
+        return super().fit_kwds
 
     def __len__(self):
         return int(np.ceil(len(self.test.index) / float(self.batch_size)))
 
-    def __getitem__(self, index):
-        """Returns the ith batch of the data to be generated."""
+    def on_epoch_end(self):
+        with self._lock:
+            self._close_prefetcher()
+
+    def _close_prefetcher(self):
+        if self._prefetcher is not None:
+            self._prefetcher.close()
+            self._prefetcher = None
+
+    def load_batch(self, index):
+        """Load the ith batch of the data."""
         batch_set = self.batch_sets[index]
         batch_index = self.test.index[batch_set]
-        x_batch = self.test.get_images(batch_index)
+        x_batch = self.test.get_images(batch_index, self.scale)
         return x_batch
+
+    def __getitem__(self, index):
+        """Returns the ith batch of the data to be generated."""
+        if not self.prefetch:
+            return self.load_batch(index)
+
+        # Callers are serialized, so no caller waits on a background thread
+        # that another has closed. The thread is restarted whenever batches
+        # are requested out of order.
+        with self._lock:
+            prefetcher = self._prefetcher
+            if prefetcher is None or prefetcher.next_index != index:
+                self._close_prefetcher()
+                prefetcher = _PrefetchWrapper(self.load_batch, index, len(self))
+                self._prefetcher = prefetcher
+            try:
+                return prefetcher.get()
+            except BaseException:
+                self._close_prefetcher()
+                raise
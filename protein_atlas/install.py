@@ -14,6 +14,7 @@ ROOT = Path(__file__).parent.parent.resolve()
 PATH = { "root"                   : ROOT,
          "data"                   : ROOT.joinpath("data"),
          "raw"                    : ROOT.joinpath("data/raw"),
+         "cache"                  : ROOT.joinpath("data/cache"),
          "test"                   : ROOT.joinpath("data/raw/test"),
          "train"                  : ROOT.joinpath("data/raw/train"),
          "train.csv"              : ROOT.joinpath("data/raw/train.csv"),